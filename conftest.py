@@ -1,17 +1,19 @@
 import os
+import io
+import tarfile
+import hashlib
 import logging
-from warnings import warn
 import pytest
+import shutil
 import tempfile
 import requests.exceptions
 from pathlib import Path
-from tempfile import mkdtemp
 from click.testing import CliRunner
 import docker
+from filelock import FileLock
 from fileformats.medimage import NiftiGzX
 from pipeline2app.core.image import Pydra2AppImage
 
-
 log_level = logging.WARNING
 
 logger = logging.getLogger("arcana")
@@ -24,12 +26,101 @@ sch.setFormatter(formatter)
 logger.addHandler(sch)
 
 PKG_DIR = Path(__file__).parent
+SHM_DIR = "/dev/shm"
+# Minimum free space required to put the temporary directories in shared memory
+SHM_MIN_FREE = 1024**3
 
 
-@pytest.fixture
+def _usable_shm_dir():
+    """Returns the shared-memory (tmpfs) directory if it can hold the temporary
+    directories of the tests, i.e. it is writable, not mounted 'noexec' (scripts are
+    executed from work directories) and has enough free space, otherwise None"""
+    try:
+        stat = os.statvfs(SHM_DIR)
+    except OSError:
+        return None
+    if stat.f_flag & getattr(os, "ST_NOEXEC", 0):
+        return None
+    if not os.access(SHM_DIR, os.W_OK | os.X_OK):
+        return None
+    if stat.f_bavail * stat.f_frsize < SHM_MIN_FREE:
+        return None
+    return SHM_DIR
+
+
+def pytest_addoption(parser):
+    # For debugging in IDE's don't catch raised exceptions and let the IDE
+    # break at it. Defaults to the '_PYTEST_RAISE' environment variable so existing
+    # IDE configurations keep working
+    parser.addoption(
+        "--raise-exc",
+        action="store_true",
+        default=os.getenv("_PYTEST_RAISE", "0") != "0",
+        help="Don't catch exceptions raised in tests, so debuggers can break at them",
+    )
+    parser.addoption(
+        "--shm-tmp",
+        action="store_true",
+        default=False,
+        help=(
+            f"Create the temporary directories of the session in {SHM_DIR} "
+            "(if it is usable) to avoid disk I/O. They are removed at the end "
+            "of the session"
+        ),
+    )
+
+
+class _RaiseExceptions:
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_exception_interact(self, call):
+        raise call.excinfo.value
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_internalerror(self, excinfo):
+        raise excinfo.value
+
+
+def pytest_configure(config):
+    if config.getoption("raise_exc"):
+        config.pluginmanager.register(_RaiseExceptions(), "raise-exceptions")
+    if (
+        config.getoption("shm_tmp")
+        and config.option.basetemp is None
+        and not hasattr(config, "workerinput")  # xdist workers inherit basetemp
+    ):
+        # Use a fresh directory for each session, as pytest wipes an explicit
+        # basetemp at the start of the session
+        shm_dir = _usable_shm_dir()
+        try:
+            if shm_dir is None:
+                raise OSError(f"{SHM_DIR} is not usable")
+            basetemp = tempfile.mkdtemp(prefix="pytest-frametree-bids-", dir=shm_dir)
+        except OSError as e:
+            config.issue_config_time_warning(
+                pytest.PytestConfigWarning(
+                    f"Falling back to the default temporary directory: {e}"
+                ),
+                stacklevel=2,
+            )
+        else:
+            config.option.basetemp = basetemp
+            config.pluginmanager.register(_ShmBaseTemp(basetemp), "shm-basetemp")
+
+
+class _ShmBaseTemp:
+    def __init__(self, path):
+        self.path = path
+
+    def pytest_unconfigure(self, config):
+        # Free the shared memory used by the session
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
 def cli_runner(catch_cli_exceptions):
+    runner = CliRunner()
+
     def invoke(*args, catch_exceptions=catch_cli_exceptions, **kwargs):
-        runner = CliRunner()
         result = runner.invoke(*args, catch_exceptions=catch_exceptions, **kwargs)
         return result
 
@@ -37,9 +128,8 @@ def cli_runner(catch_cli_exceptions):
 
 
 @pytest.fixture
-def work_dir():
-    work_dir = tempfile.mkdtemp()
-    return Path(work_dir)
+def work_dir(tmp_path):
+    return tmp_path
 
 
 @pytest.fixture(scope="session")
@@ -48,8 +138,8 @@ def pkg_dir():
 
 
 @pytest.fixture(scope="session")
-def build_cache_dir():
-    return Path(mkdtemp())
+def build_cache_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp("build_cache")
 
 
 @pytest.fixture(scope="session")
@@ -63,9 +153,7 @@ MOCK_BIDS_APP_IMAGE = "arcana-mock-bids-app"
 BIDS_VALIDATOR_APP_IMAGE = "arcana-bids-validator-app"
 
 
-@pytest.fixture(scope="session")
-def bids_validator_app_script():
-    return f"""#!/bin/sh
+BIDS_VALIDATOR_APP_SCRIPT = f"""#!/bin/sh
 # Echo inputs to get rid of any quotes
 BIDS_DATASET=$(echo $1)
 OUTPUTS_DIR=$(echo $2)
@@ -84,29 +172,32 @@ echo 'file2' > $OUTPUTS_DIR/sub-${{SUBJ_ID}}_file2.txt
 """
 
 
-# FIXME: should be converted to python script to be Windows compatible
-@pytest.fixture(scope="session")
-def mock_bids_app_script():
-    file_tests = ""
-    for inpt_path, datatype in [
-        ("anat/T1w", NiftiGzX),
-        ("anat/T2w", NiftiGzX),
-        ("dwi/dwi", NiftiGzX),
-    ]:
-        subdir, suffix = inpt_path.split("/")
-        fpath = f"$BIDS_DATASET/sub-${{SUBJ_ID}}/{subdir}/sub-${{SUBJ_ID}}_{suffix}{datatype.ext}"
-        file_tests += f"""
+def _mock_bids_app_file_test(inpt_path, datatype):
+    subdir, suffix = inpt_path.split("/")
+    fpath = f"$BIDS_DATASET/sub-${{SUBJ_ID}}/{subdir}/sub-${{SUBJ_ID}}_{suffix}{datatype.ext}"
+    return f"""
         if [ ! -f {fpath} ]; then
             echo "Did not find {suffix} file at {fpath}"
             exit 1;
         fi
         """
 
-    return f"""#!/bin/sh
+
+_MOCK_BIDS_APP_FILE_TESTS = "".join(
+    _mock_bids_app_file_test(inpt_path, datatype)
+    for inpt_path, datatype in [
+        ("anat/T1w", NiftiGzX),
+        ("anat/T2w", NiftiGzX),
+        ("dwi/dwi", NiftiGzX),
+    ]
+)
+
+# FIXME: should be converted to python script to be Windows compatible
+MOCK_BIDS_APP_SCRIPT = f"""#!/bin/sh
 BIDS_DATASET=$1
 OUTPUTS_DIR=$2
 SUBJ_ID=$5
-{file_tests}
+{_MOCK_BIDS_APP_FILE_TESTS}
 # Write mock output files to 'derivatives' Directory
 mkdir -p $OUTPUTS_DIR
 echo 'file1' > $OUTPUTS_DIR/sub-${{SUBJ_ID}}_file1.txt
@@ -115,13 +206,30 @@ echo 'file2' > $OUTPUTS_DIR/sub-${{SUBJ_ID}}_file2.txt
 
 
 @pytest.fixture(scope="session")
-def mock_bids_app_executable(build_cache_dir, mock_bids_app_script):
+def bids_validator_app_script():
+    return BIDS_VALIDATOR_APP_SCRIPT
+
+
+@pytest.fixture(scope="session")
+def mock_bids_app_script():
+    return MOCK_BIDS_APP_SCRIPT
+
+
+@pytest.fixture(scope="session")
+def mock_bids_app_executable(request, build_cache_dir, mock_bids_app_script):
     # Create executable that runs validator then produces some mock output
-    # files
-    script_path = build_cache_dir / "mock-bids-app-executable.sh"
-    with open(script_path, "w") as f:
-        f.write(mock_bids_app_script)
-    os.chmod(script_path, 0o777)
+    # files. The script is named by the hash of its contents and stored in the
+    # pytest cache (when enabled) so it is only written once across sessions
+    digest = hashlib.sha1(mock_bids_app_script.encode()).hexdigest()[:12]
+    cache = getattr(request.config, "cache", None)
+    script_dir = cache.mkdir("mock-bids-app") if cache is not None else build_cache_dir
+    script_path = script_dir / f"mock-bids-app-{digest}.sh"
+    if not script_path.exists():
+        tmp_path = script_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(mock_bids_app_script)
+        os.chmod(tmp_path, 0o777)
+        os.replace(tmp_path, script_path)
     return script_path
 
 
@@ -131,135 +239,168 @@ def bids_success_str():
 
 
 @pytest.fixture(scope="session")
-def bids_validator_docker():
-    dc = docker.from_env()
+def docker_client():
+    return docker.from_env()
+
+
+@pytest.fixture(scope="session")
+def bids_validator_docker(docker_client):
+    # Only pull the validator if it isn't already present, to avoid a registry
+    # round-trip (or a stall when offline) at the start of every session
     try:
-        dc.images.pull(BIDS_VALIDATOR_DOCKER)
-    except requests.exceptions.HTTPError:
-        warn("No internet connection, so couldn't download latest BIDS validator")
+        docker_client.images.get(BIDS_VALIDATOR_DOCKER)
+    except docker.errors.ImageNotFound:
+        try:
+            docker_client.images.pull(BIDS_VALIDATOR_DOCKER)
+        except (
+            requests.exceptions.HTTPError,
+            requests.exceptions.ConnectionError,
+        ):
+            pytest.skip("No BIDS validator image available and couldn't download it")
     return BIDS_VALIDATOR_DOCKER
 
 
 @pytest.fixture(scope="session")
 def bids_validator_app_image(
-    bids_validator_app_script, bids_validator_docker, build_cache_dir
+    bids_validator_app_script, bids_validator_docker, docker_client
 ):
     return build_app_image(
         BIDS_VALIDATOR_APP_IMAGE,
         bids_validator_app_script,
-        build_cache_dir,
         base_image=bids_validator_docker,
+        client=docker_client,
     )
 
 
 @pytest.fixture(scope="session")
-def mock_bids_app_image(mock_bids_app_script, build_cache_dir):
+def mock_bids_app_image(mock_bids_app_script, docker_client):
     return build_app_image(
         MOCK_BIDS_APP_IMAGE,
         mock_bids_app_script,
-        build_cache_dir,
         base_image=Pydra2AppImage().reference,
+        client=docker_client,
     )
 
 
-def build_app_image(tag_name, script, build_cache_dir, base_image):
-    dc = docker.from_env()
+def build_app_image(tag_name, script, base_image, client=None):
+    dc = client if client is not None else docker.from_env()
 
-    # Create executable that runs validator then produces some mock output
-    # files
-    build_dir = build_cache_dir / tag_name.replace(":", "__i__")
-    build_dir.mkdir()
-    launch_sh = build_dir / "launch.sh"
-    with open(launch_sh, "w") as f:
-        f.write(script)
-
-    # Build mock BIDS app image
-    with open(build_dir / "Dockerfile", "w") as f:
-        f.write(
+    # Build mock BIDS app image from an in-memory build context containing the
+    # executable that runs validator then produces some mock output files
+    context_files = (
+        (
+            "Dockerfile",
             f"""FROM {base_image}
 ADD ./launch.sh /launch.sh
 RUN chmod +x /launch.sh
-ENTRYPOINT ["/launch.sh"]"""
+ENTRYPOINT ["/launch.sh"]""",
+        ),
+        ("launch.sh", script),
+    )
+    # Tag the image with a hash of the full build context and the ID of the base
+    # image (as its reference may be a mutable tag) so that images built in
+    # previous sessions can be reused without rebuilding
+    hsh = hashlib.sha1(_image_id(dc, base_image).encode())
+    for fname, contents in context_files:
+        hsh.update(f"\0{fname}\0{contents}".encode())
+    tag = f"{tag_name}:{hsh.hexdigest()[:12]}"
+    # Lock on a path shared between sessions and pytest-xdist workers so that only
+    # one of them builds the image while the others wait for it and reuse it
+    lock_path = os.path.join(tempfile.gettempdir(), tag.replace(":", "__i__") + ".lock")
+    with FileLock(lock_path):
+        try:
+            dc.images.get(tag)
+        except docker.errors.ImageNotFound:
+            pass
+        else:
+            return tag
+
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode="w") as tar:
+            for fname, contents in context_files:
+                data = contents.encode()
+                info = tarfile.TarInfo(fname)
+                info.size = len(data)
+                info.mode = 0o755
+                tar.addfile(info, io.BytesIO(data))
+        context.seek(0)
+        dc.images.build(
+            fileobj=context,
+            custom_context=True,
+            tag=tag,
+            rm=True,
+            forcerm=True,
+            pull=False,
         )
 
-    dc.images.build(path=str(build_dir), tag=tag_name)
+    return tag
 
-    return tag_name
 
+def _image_id(dc, image):
+    """Returns the ID of a local image, pulling it first if it isn't present"""
+    try:
+        return dc.images.get(image).id
+    except docker.errors.ImageNotFound:
+        return dc.images.pull(image).id
 
-@pytest.fixture(scope="session")
-def bids_command_spec(mock_bids_app_executable):
-    inputs = {
-        "T1w": {
-            "configuration": {
-                "path": "anat/T1w",
-            },
-            "datatype": "medimage:NiftiGzX",
-            "help": "T1-weighted image",
+
+BIDS_COMMAND_INPUTS = {
+    "T1w": {
+        "configuration": {
+            "path": "anat/T1w",
         },
-        "T2w": {
-            "configuration": {
-                "path": "anat/T2w",
-            },
-            "datatype": "medimage:NiftiGzX",
-            "help": "T2-weighted image",
+        "datatype": "medimage:NiftiGzX",
+        "help": "T1-weighted image",
+    },
+    "T2w": {
+        "configuration": {
+            "path": "anat/T2w",
         },
-        "DWI": {
-            "configuration": {
-                "path": "dwi/dwi",
-            },
-            "datatype": "medimage:NiftiGzXBvec",
-            "help": "DWI-weighted image",
+        "datatype": "medimage:NiftiGzX",
+        "help": "T2-weighted image",
+    },
+    "DWI": {
+        "configuration": {
+            "path": "dwi/dwi",
         },
-    }
+        "datatype": "medimage:NiftiGzXBvec",
+        "help": "DWI-weighted image",
+    },
+}
 
-    outputs = {
-        "file1": {
-            "configuration": {
-                "path": "file1",
-            },
-            "datatype": "common:Text",
-            "help": "an output file",
+BIDS_COMMAND_OUTPUTS = {
+    "file1": {
+        "configuration": {
+            "path": "file1",
         },
-        "file2": {
-            "configuration": {
-                "path": "file2",
-            },
-            "datatype": "common:Text",
-            "help": "another output file",
+        "datatype": "common:Text",
+        "help": "an output file",
+    },
+    "file2": {
+        "configuration": {
+            "path": "file2",
         },
-    }
+        "datatype": "common:Text",
+        "help": "another output file",
+    },
+}
+
 
+@pytest.fixture(scope="session")
+def bids_command_spec(mock_bids_app_executable):
     return {
         "task": "frametree.bids.tasks:bids_app",
-        "inputs": inputs,
-        "outputs": outputs,
+        "inputs": BIDS_COMMAND_INPUTS,
+        "outputs": BIDS_COMMAND_OUTPUTS,
         "row_frequency": "session",
         "configuration": {
-            "inputs": inputs,
-            "outputs": outputs,
+            "inputs": BIDS_COMMAND_INPUTS,
+            "outputs": BIDS_COMMAND_OUTPUTS,
             "executable": str(mock_bids_app_executable),
         },
     }
 
 
-# For debugging in IDE's don't catch raised exceptions and let the IDE
-# break at it
-if os.getenv("_PYTEST_RAISE", "0") != "0":
-
-    @pytest.hookimpl(tryfirst=True)
-    def pytest_exception_interact(call):
-        raise call.excinfo.value
-
-    @pytest.hookimpl(tryfirst=True)
-    def pytest_internalerror(excinfo):
-        raise excinfo.value
-
-    CATCH_CLI_EXCEPTIONS = False
-else:
-    CATCH_CLI_EXCEPTIONS = True
-
-
-@pytest.fixture
-def catch_cli_exceptions():
-    return CATCH_CLI_EXCEPTIONS
+@pytest.fixture(scope="session")
+def catch_cli_exceptions(request):
+    return not request.config.getoption("raise_exc")
@@ -1,12 +1,20 @@
 from __future__ import annotations
+import os
 import typing as ty
 import json
 import re
 import logging
-from operator import itemgetter
+import functools
+import string
+from copy import deepcopy
 import attrs
 import jq
 from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from frametree.core.store import LocalStore
 from fileformats.core import FileSet, Field
 from fileformats.generic import Directory
@@ -20,8 +28,23 @@ from frametree.core.row import DataRow
 
 logger = logging.getLogger("frametree")
 
+_TASK_RE = re.compile(r"/task=([^/]+)")
+# Runs of digits that could be an integer outside of the 64-bit range orjson supports
+_LONG_DIGITS_RE = re.compile(rb"\d{20}")
+# entities that are encoded in the row (i.e. subject/session) directories
+_ROW_ENTITIES = frozenset(("sub", "ses"))
+# Matches jq filters that only assign a literal to a key, e.g. '.TaskName = "rest"'.
+# ASCII-only so that keys jq wouldn't accept as identifiers fall back to jq
+_ASSIGNMENT_RE = re.compile(
+    r"\s*\.([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)\s*=\s*(.+?)\s*", re.ASCII
+)
+# Matches '\uXXXX' escapes of UTF-16 surrogates in JSON strings
+_SURROGATE_ESCAPE_RE = re.compile(r"\\u[dD][89a-fA-F]")
+# Largest integer magnitude that jq (which uses doubles) represents exactly
+_MAX_EXACT_INT = 2**53
 
-@attrs.define
+
+@attrs.define(frozen=True)
 class JsonEdit:
 
     path: str
@@ -32,6 +55,38 @@ class JsonEdit:
     # exception that '{a_column_name}' will be substituted by the file path of
     # the item matching the column ('{' and '}' need to be escaped by duplicating,
     # i.e. '{{' and '}}').
+    # The compiled regex and parsed expression below are derived from the fields
+    # above, which is why the class is frozen
+    _path_re: ty.Pattern = attrs.field(init=False, repr=False, eq=False)
+    _placeholders: ty.FrozenSet[str] = attrs.field(init=False, repr=False, eq=False)
+    # the formatted expression of edits that don't reference any columns
+    _static_jq_expr: ty.Optional[str] = attrs.field(init=False, repr=False, eq=False)
+
+    @_path_re.default
+    def _path_re_default(self) -> ty.Pattern:
+        return re.compile(self.path)
+
+    @_placeholders.default
+    def _placeholders_default(self) -> ty.FrozenSet[str]:
+        return frozenset(
+            name
+            for _, name, _, _ in string.Formatter().parse(self.jq_expr)
+            if name is not None
+        )
+
+    @_static_jq_expr.default
+    def _static_jq_expr_default(self) -> ty.Optional[str]:
+        return None if self._placeholders else self.jq_expr.format()
+
+    def matches(self, path: str) -> bool:
+        """Whether the edit applies to the given entry path"""
+        return self._path_re.match(path) is not None
+
+    def format_jq_expr(self, col_fspaths: ty.Mapping[str, str]) -> str:
+        """Substitutes the paths of the columns into the jq expression"""
+        if self._static_jq_expr is not None:
+            return self._static_jq_expr
+        return self.jq_expr.format_map(col_fspaths)
 
     @classmethod
     def attr_converter(cls, json_edits: list) -> list:
@@ -39,12 +94,13 @@ class JsonEdit:
             return []
         parsed = []
         for x in json_edits:
-            if isinstance(x, JsonEdit):
+            # Edits are most commonly loaded from YAML/JSON configs as dicts
+            if isinstance(x, dict):
+                parsed.append(cls(**x))
+            elif isinstance(x, cls):
                 parsed.append(x)
-            elif isinstance(x, dict):
-                parsed.append(JsonEdit(**x))
             else:
-                parsed.append(JsonEdit(*x))
+                parsed.append(cls(*x))
         return parsed
 
 
@@ -73,6 +129,7 @@ class Bids(LocalStore):
     PROV_SUFFIX = ".provenance"
     FIELDS_FNAME = "__fields__"
     FIELDS_PROV_FNAME = "__fields_provenance__"
+    FIELDS_FNAMES = frozenset((FIELDS_FNAME, FIELDS_PROV_FNAME))
 
     VALID_HIERARCHIES = (
         ["subject", "visit"],
@@ -97,9 +154,10 @@ class Bids(LocalStore):
         dataset : FrameSet
             The dataset to construct the tree dimensions for
         """
-        root_dir = Path(tree.frameset.id)
-        if "group" in tree.frameset.hierarchy:
-            with open(root_dir / "participants.tsv") as f:
+        root_dir = tree.frameset.id
+        has_groups = "group" in tree.frameset.hierarchy
+        if has_groups:
+            with open(os.path.join(root_dir, "participants.tsv")) as f:
                 lines = f.read().splitlines()
             participants = {}
             if lines:
@@ -107,67 +165,88 @@ class Bids(LocalStore):
                 for line in lines[1:]:
                     dct = dict(zip(participant_keys, line.split("\t")))
                     participants[dct.pop("participant_id")[len("sub-") :]] = dct
-        for subject_dir in root_dir.iterdir():
-            if not subject_dir.name.startswith("sub-"):
-                continue
-            subject_id = subject_dir.name[len("sub-") :]
-            if "group" in tree.frameset.hierarchy:
+        with os.scandir(root_dir) as subject_dirs:
+            subject_names = [d.name for d in subject_dirs if d.name.startswith("sub-")]
+        add_leaf = tree.add_leaf
+        for subject_name in subject_names:
+            subject_id = subject_name[len("sub-") :]
+            if has_groups:
                 tree_path = [participants[subject_id]["group"]]
             else:
                 tree_path = []
             tree_path.append(subject_id)
-            if any(d.name.startswith("ses-") for d in subject_dir.iterdir()):
-                for sess_dir in subject_dir.iterdir():
-                    visit_id = sess_dir.name[len("ses-") :]
-                    tree.add_leaf(tree_path + [visit_id])
+            # List the subject directory once and reuse the names for both the
+            # multi-session check and the visit IDs
+            with os.scandir(os.path.join(root_dir, subject_name)) as sub_entries:
+                visit_ids = [
+                    e.name[len("ses-") :]
+                    for e in sub_entries
+                    if e.name.startswith("ses-") and e.is_dir()
+                ]
+            if visit_ids:
+                for visit_id in visit_ids:
+                    add_leaf(tree_path + [visit_id])
             else:
-                tree.add_leaf([subject_id])
+                add_leaf([subject_id])
 
     def populate_row(self, row: DataRow):
         root_dir = row.frameset.root_dir
         relpath = self._rel_row_path(row)
         session_path = root_dir / relpath
         session_path.mkdir(exist_ok=True)
-        for modality_dir in session_path.iterdir():
-            for entry_fspath in modality_dir.iterdir():
-                # suffix = "".join(entry_fspath.suffixes)
-                path = self._fs2entry_path(entry_fspath.relative_to(session_path))
-                # path = path.split(".")[0] + "/" + suffix.lstrip(".")
+        # Build URIs by joining plain strings, which is much cheaper than
+        # creating and diffing Path objects for every entry
+        relpath_str = str(relpath)
+        with os.scandir(session_path) as modality_dirs:
+            for modality_dir in modality_dirs:
+                # Skip files stored at the session level (e.g. *_scans.tsv)
+                if not modality_dir.is_dir():
+                    continue
+                with os.scandir(modality_dir.path) as entries:
+                    for entry in entries:
+                        entry_relpath = os.path.join(modality_dir.name, entry.name)
+                        row.add_entry(
+                            path=self._fs2entry_path(entry_relpath),
+                            datatype=FileSet,
+                            uri=os.path.join(relpath_str, entry_relpath),
+                        )
+        deriv_dir = root_dir / "derivatives"
+        if not deriv_dir.exists():
+            return
+        prov_suffix = self.PROV_SUFFIX
+        fields_fnames = self.FIELDS_FNAMES
+        with os.scandir(deriv_dir) as pipeline_dirs:
+            for pipeline_dir in pipeline_dirs:
+                pipeline_row_dir = os.path.join(pipeline_dir.path, relpath_str)
+                # Skip pipelines that didn't produce outputs for this row and files
+                # stored at the top level of the derivatives directory
+                if not os.path.isdir(pipeline_row_dir):
+                    continue
+                pipeline_row_uri = os.path.join(
+                    "derivatives", pipeline_dir.name, relpath_str
+                )
+                # Add in the whole row directory as an entry
                 row.add_entry(
-                    path=path,
-                    datatype=FileSet,
-                    uri=str(entry_fspath.relative_to(root_dir)),
+                    path="@" + pipeline_dir.name,
+                    datatype=Directory,
+                    uri=pipeline_row_uri,
                 )
-        deriv_dir = root_dir / "derivatives"
-        if deriv_dir.exists():
-            for pipeline_dir in deriv_dir.iterdir():
-                pipeline_row_dir = pipeline_dir / relpath
-                if pipeline_row_dir.exists():
-                    # Add in the whole row directory as an entry
-                    row.add_entry(
-                        path="@" + pipeline_dir.name,
-                        datatype=Directory,
-                        uri=pipeline_row_dir.relative_to(root_dir),
-                    )
-                    for entry_fspath in pipeline_row_dir.iterdir():
-                        if not (
-                            entry_fspath.name.startswith(".")
-                            or entry_fspath.name
-                            in (self.FIELDS_FNAME, self.FIELDS_PROV_FNAME)
-                            or entry_fspath.name.endswith(self.PROV_SUFFIX)
+                with os.scandir(pipeline_row_dir) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        # Skip hidden files, provenance side-cars and the field
+                        # files, which are accessed via the field methods instead
+                        if (
+                            name[0] == "."
+                            or name.endswith(prov_suffix)
+                            or name in fields_fnames
                         ):
-                            path = (
-                                self._fs2entry_path(entry_fspath.name)
-                                + "@"
-                                + pipeline_dir.name
-                            )
-                            # suffix = "".join(entry_fspath.suffixes)
-                            # path = path[: -len(suffix)] + "/" + suffix.lstrip(".")
-                            row.add_entry(
-                                path=path,
-                                datatype=FileSet,
-                                uri=str(entry_fspath.relative_to(root_dir)),
-                            )
+                            continue
+                        row.add_entry(
+                            path=self._fs2entry_path(name) + "@" + pipeline_dir.name,
+                            datatype=FileSet,
+                            uri=os.path.join(pipeline_row_uri, name),
+                        )
 
     def fileset_uri(self, path: str, datatype: type, row: DataRow) -> str:
         path, dataset_name = DataEntry.split_dataset_name_from_path(path)
@@ -252,21 +331,16 @@ class Bids(LocalStore):
         self.update_json(fspath, key, field.primitive(field))
 
     def get_fileset_provenance(self, entry: DataEntry) -> ty.Dict[str, ty.Any]:
-        with open(self._fileset_prov_fspath(entry)) as f:
-            provenance = json.load(f)
-        return provenance
+        return _json_load(self._fileset_prov_fspath(entry))
 
     def put_fileset_provenance(
         self, provenance: ty.Dict[str, ty.Any], entry: DataEntry
     ):
-        with open(self._fileset_prov_fspath(entry), "w") as f:
-            json.dump(provenance, f)
+        _json_dump(self._fileset_prov_fspath(entry), provenance)
 
     def get_field_provenance(self, entry: DataEntry) -> ty.Dict[str, ty.Any]:
         fspath, key = self._fields_prov_fspath_and_key(entry)
-        with open(fspath) as f:
-            fields_provenance = json.load(f)
-        return fields_provenance[key]
+        return _json_load(fspath)[key]
 
     def put_field_provenance(self, provenance: ty.Dict[str, ty.Any], entry: DataEntry):
         fspath, key = self._fields_prov_fspath_and_key(entry)
@@ -290,6 +364,7 @@ class Bids(LocalStore):
         # Create sub-directories corresponding to rows of the dataset
         group_ids = set()
         subjects_group_id = {}
+        session_dirs = set()
         for ids_tuple in leaves:
             ids = dict(zip(hierarchy, ids_tuple))
             # Add in composed IDs
@@ -302,16 +377,21 @@ class Bids(LocalStore):
             if group_id:
                 group_ids.add(group_id)
                 subjects_group_id[subject_id] = group_id
-            sess_dir_fspath = root_dir / self._entry2fs_path(
-                entry_path=None, subject_id=subject_id, visit_id=visit_id
+            session_dirs.add(
+                self._entry2fs_path(
+                    entry_path=None, subject_id=subject_id, visit_id=visit_id
+                )
             )
-            sess_dir_fspath.mkdir(parents=True, exist_ok=True)
+        # Create each unique session directory once after all the leaves have been
+        # processed
+        for sess_dir in sorted(session_dirs):
+            os.makedirs(root_dir / sess_dir, exist_ok=True)
         # Add participants.tsv to define the groups if present
         if group_ids:
+            lines = ["participant_id\tgroup\n"]
+            lines.extend(f"sub-{s}\t{g}\n" for s, g in subjects_group_id.items())
             with open(root_dir / "participants.tsv", "w") as f:
-                f.write("participant_id\tgroup\n")
-                for subject_id, group_id in subjects_group_id.items():
-                    f.write(f"sub-{subject_id}\t{group_id}\n")
+                f.writelines(lines)
 
     ####################
     # Overrides of API #
@@ -368,8 +448,7 @@ class Bids(LocalStore):
             attrs.asdict(dataset.metadata, recurse=True)
         )
         dataset_description["BIDSVersion"] = self.BIDS_VERSION
-        with open(dataset_description_fspath, "w") as f:
-            json.dump(dataset_description, f, indent="    ")
+        _json_dump(dataset_description_fspath, dataset_description, indent=True)
 
         if dataset.metadata.description is not None:
             readme_path = root_dir / "README"
@@ -378,38 +457,36 @@ class Bids(LocalStore):
         columns = list(dataset.metadata.row_metadata)
         group_ids = [i for i in dataset.row_ids("group") if i is not None]
         if group_ids or columns:
-            subject_rows = dataset.rows("subject")
-            with open(dataset.root_dir / "participants.tsv", "w") as f:
-                f.write("participant_id")
+            header = ["participant_id"]
+            if group_ids:
+                header.append("group")
+            header.extend(columns)
+            lines = ["\t".join(header) + "\n"]
+            for row in dataset.rows("subject"):
+                values = [f"sub-{row.id}"]
                 if group_ids:
-                    f.write("\tgroup")
-                if columns:
-                    f.write("\t" + "\t".join(columns))
-                f.write("\n")
-                for row in subject_rows:
-                    f.write(f"sub-{row.id}")
-                    if group_ids:
-                        f.write("\t" + row.frequency_id("group"))
-                    if columns:
-                        f.write("\t" + "\t".join(row.metadata[k] for k in columns))
-                    f.write("\n")
+                    values.append(row.frequency_id("group"))
+                values.extend(row.metadata[k] for k in columns)
+                lines.append("\t".join(values) + "\n")
+            # Write all lines in one go to avoid many small writes for large cohorts
+            with open(dataset.root_dir / "participants.tsv", "w") as f:
+                f.writelines(lines)
             participants_desc = {}
             if group_ids:
                 participants_desc["group"] = {
                     "Description": "the group the participant belonged to",
-                    "Levels": {g: f"{g} group" for g in dataset.row_ids("group")},
+                    "Levels": {g: f"{g} group" for g in group_ids},
                 }
             for name, desc in dataset.metadata.row_metadata.items():
                 participants_desc[name] = {"Description": desc}
-            with open(dataset.root_dir / "participants.json", "w") as f:
-                json.dump(participants_desc, f)
+            _json_dump(dataset.root_dir / "participants.json", participants_desc)
 
     def _fileset_fspath(self, entry: DataEntry) -> Path:
-        return Path(entry.row.frameset.id) / entry.uri
+        return Path(entry.row.frameset.id, entry.uri)
 
     def _fields_fspath_and_key(self, entry: DataEntry) -> ty.Tuple[Path, str]:
         relpath, key = entry.uri.split("::")
-        fspath = Path(entry.row.frameset.id) / relpath
+        fspath = Path(entry.row.frameset.id, relpath)
         return fspath, key
 
     def _fileset_prov_fspath(self, entry: DataEntry) -> Path:
@@ -428,57 +505,70 @@ class Bids(LocalStore):
         fspath : str
             Path of the JSON to potentially edit
         """
-        with open(nifti_x.json_file) as f:
-            json_dict = json.load(f)
+        task_match = _TASK_RE.search(entry.path)
+        matching_edits = [j for j in self.json_edits if j.matches(entry.path)]
+        # Most side-cars (e.g. anat, dwi) don't need editing at all, in which case
+        # we can avoid reading them
+        if not (task_match or matching_edits):
+            return
+        json_dict = _json_load(nifti_x.json_file)
+        # Compare the serialised documents rather than the dictionaries to detect
+        # changes, as dict equality ignores key order and treats True == 1 == 1.0
+        orig_data = _json_dumps(json_dict)
 
         # Ensure there is a value for TaskName for files that include 'task-taskname'
         # in their file path
-        if match := re.match(r".*/task=([^/]+)", entry.path):
-            if "TaskName" not in json_dict:
-                json_dict["TaskName"] = match.group(1)
-        # Get dictionary containing file paths for all items in the same row
-        # as the file-set so they can be used in the edits using Python
-        # string templating
-        col_fspaths = {}
-        for cell in entry.row.cells():
-            if cell.is_empty:
-                cell_uri = self.fileset_uri(cell.column.path, cell.datatype, entry.row)
-            else:
-                cell_uri = cell.entry.uri
-            try:
-                col_fspaths[cell.column.name] = Path(cell_uri).relative_to(
-                    self._rel_row_path(entry.row)
-                )
-            except ValueError:
-                pass
-        for jedit in self.json_edits:
-            jq_expr = jedit.jq_expr.format(**col_fspaths)  # subst col file paths
-            if re.match(jedit.path, entry.path):
-                json_dict = jq.compile(jq_expr).input(json_dict).first()
-        # Write dictionary back to file if it has been loaded
-        with open(nifti_x.json_file, "w") as f:
-            json.dump(json_dict, f)
+        if task_match and "TaskName" not in json_dict:
+            json_dict["TaskName"] = task_match.group(1)
+        if matching_edits:
+            # Mapping of column names to the file paths of the items in the same
+            # row as the file-set, which are substituted into the edits using
+            # Python string templating. Columns are only resolved when they are
+            # referenced by an edit
+            col_fspaths = _LazyColPaths(functools.partial(self._col_fspath, entry.row))
+            for jedit in matching_edits:
+                jq_expr = jedit.format_jq_expr(col_fspaths)  # subst col file paths
+                json_dict = _apply_jq_edit(json_dict, jq_expr)
+        # Write dictionary back to file only if it has been changed
+        data = _json_dumps(json_dict)
+        if data != orig_data:
+            with open(nifti_x.json_file, "wb") as f:
+                f.write(data)
+
+    def _col_fspath(self, row: DataRow, column_name: str) -> str:
+        """Returns the file-system path, relative to the row directory, of the
+        item in the given column of the row"""
+        cell = row.cell(column_name)
+        if cell.is_empty:
+            cell_uri = self.fileset_uri(cell.column.path, cell.datatype, row)
+        else:
+            cell_uri = cell.entry.uri
+        try:
+            return _strip_prefix(str(cell_uri), str(self._rel_row_path(row)))
+        except ValueError:
+            raise KeyError(column_name) from None
 
     @classmethod
-    def _extract_entities(cls, relpath: Path) -> ty.Tuple[str, ty.List[str], str]:
+    def _extract_entities(
+        cls, relpath: ty.Union[str, Path]
+    ) -> ty.Tuple[str, ty.List[str], str]:
         relpath = Path(relpath)
         path = relpath.parent
-        name_parts = relpath.name.split(".")
-        stem = name_parts[0]
-        suffix = ".".join(name_parts[1:])
+        stem, _, suffix = relpath.name.partition(".")
         parts = stem.split("_")
         path /= parts[-1]
-        entities = sorted((tuple(p.split("-")) for p in parts[:-1]), key=itemgetter(0))
+        entities = [tuple(p.split("-", 1)) for p in parts[:-1]]
+        entities.sort()
         return str(path), entities, suffix
 
     @classmethod
-    def _fs2entry_path(cls, relpath: Path) -> str:
+    def _fs2entry_path(cls, relpath: ty.Union[str, Path]) -> str:
         """Converts a BIDS filename into an FrameTree "entry-path".
         Entities not corresponding to subject and session IDs
 
         Parameters
         ----------
-        relpath : Path
+        relpath : str or Path
             the relative path to the file from the subject/session directory
 
         Returns
@@ -487,15 +577,16 @@ class Bids(LocalStore):
             the "path" of an entry relative to the subject/session row.
         """
         entry_path, entities, suffix = cls._extract_entities(relpath)
-        for key, val in entities:
-            if key not in ("sub", "ses"):
-                entry_path += f"/{key}={val}"
-        return entry_path + "/" + suffix
+        parts = [entry_path]
+        parts.extend(f"{k}={v}" for k, v in entities if k not in _ROW_ENTITIES)
+        parts.append(suffix)
+        return "/".join(parts)
 
     @classmethod
+    @functools.lru_cache(maxsize=4096)
     def _entry2fs_path(
         cls,
-        entry_path: str,
+        entry_path: ty.Optional[str],
         subject_id: str,
         visit_id: ty.Optional[str] = None,
         ext: str = "",
@@ -505,8 +596,9 @@ class Bids(LocalStore):
 
         Parameters
         ----------
-        path : str
-            a path of an entry to be converted into a BIDS file-path
+        path : str or None
+            a path of an entry to be converted into a BIDS file-path. If None, the
+            path to the subject/session directory is returned
         subject_id : str
             the subject ID of the entry
         visit_id : str, optional
@@ -519,36 +611,39 @@ class Bids(LocalStore):
         rel_path : Path
             relative path to the file corresponding to the given entry path
         """
-        if entry_path is not None:
-            parts = entry_path.rstrip("/").split("/")
-            if len(parts) < 2:
-                raise FrameTreeUsageError(
-                    "BIDS paths should contain at least two '/' delimited parts (e.g. "
-                    f"anat/T1w or freesurfer/recon-all), given '{entry_path}'"
-                )
+        if entry_path is None:
+            # Path to the subject/session directory
+            if visit_id is None:
+                return Path(f"sub-{subject_id}")
+            return Path(f"sub-{subject_id}", f"ses-{visit_id}")
+        parts = entry_path.rstrip("/").split("/")
+        if len(parts) < 2:
+            raise FrameTreeUsageError(
+                "BIDS paths should contain at least two '/' delimited parts (e.g. "
+                f"anat/T1w or freesurfer/recon-all), given '{entry_path}'"
+            )
         fname = f"sub-{subject_id}"
-        relpath = Path(f"sub-{subject_id}")
+        # Collect the directory names and only create a Path at the end
+        dir_names = [fname]
         if visit_id is not None:
             fname += f"_ses-{visit_id}"
-            relpath /= f"ses-{visit_id}"
-        if entry_path is not None:
-            entities = []
-            relpath /= parts[0]  # BIDS data type or dataset/pipeline name
-            for part in parts[2:]:
-                if "=" in part:
-                    entities.append(part.split("="))
-                else:
-                    relpath /= part
-            fname += (
-                "".join(
-                    f"_{k}-{v}" for k, v in sorted(entities, key=itemgetter(0))
-                )  # BIDS entities
-                + "_"
-                + parts[1]  # BIDS modality suffix
-            )
-            relpath /= fname
-            if ext:
-                relpath = relpath.with_suffix(ext)
+            dir_names.append(f"ses-{visit_id}")
+        entities = []
+        dir_names.append(parts[0])  # BIDS data type or dataset/pipeline name
+        for part in parts[2:]:
+            if "=" in part:
+                entities.append(part.split("=", 1))
+            else:
+                dir_names.append(part)
+        entities.sort()
+        fname += (
+            "".join(f"_{k}-{v}" for k, v in entities)  # BIDS entities
+            + "_"
+            + parts[1]  # BIDS modality suffix
+        )
+        relpath = Path(*dir_names, fname)
+        if ext:
+            relpath = relpath.with_suffix(ext)
         return relpath
 
     @classmethod
@@ -562,6 +657,130 @@ class Bids(LocalStore):
         return Path(dataset_id) / "derivatives" / name / "definition.yaml"
 
 
+class _LazyColPaths(dict):
+    """Dictionary of column file-system paths that are only computed (and cached)
+    the first time they are looked up"""
+
+    def __init__(self, compute: ty.Callable[[str], str]):
+        super().__init__()
+        self._compute = compute
+
+    def __missing__(self, column_name: str) -> str:
+        fspath = self[column_name] = self._compute(column_name)
+        return fspath
+
+
+def _strip_prefix(path: str, prefix: str) -> str:
+    """Returns the path relative to the prefix directory by slicing the strings,
+    raising a ValueError (like Path.relative_to) if it isn't within it"""
+    if not path.startswith(prefix + os.sep):
+        raise ValueError(f"'{path}' is not within '{prefix}'")
+    return path[len(prefix) + 1 :]
+
+
+@functools.lru_cache(maxsize=256)
+def _compiled_jq(jq_expr: str):
+    """Compiles a jq program, caching the result as the same handful of edits are
+    typically applied to every side-car written to the store"""
+    return jq.compile(jq_expr)
+
+
+def _json_load(fspath: ty.Union[str, Path]) -> ty.Any:
+    """Loads a JSON file, using orjson to parse it if it is installed. Documents that
+    orjson would parse differently from the json module (i.e. ones containing
+    NaN/Infinity, which orjson rejects, or integers too large for 64 bits, which it
+    converts to floats) are parsed with the json module instead"""
+    with open(fspath, "rb") as f:
+        data = f.read()
+    if orjson is not None and _LONG_DIGITS_RE.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def _json_dumps(obj: ty.Any, indent: bool = False) -> bytes:
+    """Serialises an object to JSON, compact unless 'indent' is set, in which case it
+    is indented by two spaces. Always uses the json module so the output doesn't
+    depend on whether orjson is installed (orjson writes NaN as null, formats floats
+    differently and can't serialise integers beyond 64 bits)"""
+    if indent:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _json_dump(fspath: ty.Union[str, Path], obj: ty.Any, indent: bool = False):
+    """Saves an object to a JSON file (see _json_dumps)"""
+    with open(fspath, "wb") as f:
+        f.write(_json_dumps(obj, indent=indent))
+
+
+@functools.lru_cache(maxsize=256)
+def _simple_assignment(
+    jq_expr: str,
+) -> ty.Optional[ty.Tuple[ty.Tuple[str, ...], ty.Any]]:
+    """Parses jq filters of the form '.a.b = <JSON literal>', returning the keys and
+    the value to assign, or None if the filter is anything more complex"""
+    match = _ASSIGNMENT_RE.fullmatch(jq_expr)
+    if match is None:
+        return None
+    literal = match.group(2)
+    # Escaped surrogates are left to jq, which rejects unpaired ones
+    if _SURROGATE_ESCAPE_RE.search(literal):
+        return None
+    try:
+        # Only accept literals that jq would represent identically, leaving floats
+        # (which jq normalises, e.g. 2.0 to 2, and clamps when out of range),
+        # integers that can't be represented exactly as doubles, and NaN/Infinity
+        # (which jq rejects) to jq
+        value = json.loads(
+            literal,
+            parse_constant=_reject_json_literal,
+            parse_float=_reject_json_literal,
+            parse_int=_parse_exact_int,
+        )
+    except ValueError:
+        return None
+    return tuple(match.group(1).split(".")), value
+
+
+def _reject_json_literal(literal: str) -> ty.NoReturn:
+    raise ValueError(f"{literal} is not assigned directly")
+
+
+def _parse_exact_int(literal: str) -> int:
+    value = int(literal)
+    if abs(value) > _MAX_EXACT_INT:
+        raise ValueError(f"{literal} can't be represented exactly by jq")
+    return value
+
+
+def _apply_jq_edit(json_dict: ty.Any, jq_expr: str) -> ty.Any:
+    """Applies a jq filter to a JSON document, assigning the value directly
+    instead of running the jq program if the filter is a simple assignment.
+    Like jq, the input document is not modified"""
+    assignment = _simple_assignment(jq_expr)
+    if assignment is not None and isinstance(json_dict, dict):
+        keys, value = assignment
+        edited = dict(json_dict)
+        node = edited
+        for key in keys[:-1]:
+            child = node.get(key)
+            if child is None:
+                child = {}
+            elif isinstance(child, dict):
+                child = dict(child)
+            else:
+                break  # let jq handle (and report) assignments into non-objects
+            node[key] = child
+            node = child
+        else:
+            node[keys[-1]] = deepcopy(value)
+            return edited
+    return _compiled_jq(jq_expr).input(json_dict).first()
+
+
 def outputs_converter(outputs):
     """Sets the path of an output to '' if not provided or None"""
     return [o[:2] + ("",) if len(o) < 3 or o[2] is None else o for o in outputs]
@@ -613,7 +832,7 @@ def map_to_bids_names(dct, mappings=METADATA_MAPPING):
         m[1]: (
             dct[m[0]]
             if len(m) == 2
-            else [map_to_bids_names(i, mappings=m[2]) for i in dct[m[0]]]
+            else _map_nested(map_to_bids_names, dct[m[0]], m[2])
         )
         for m in mappings
         if dct[m[0]] is not None
@@ -625,8 +844,16 @@ def map_from_bids_names(dct, mappings=METADATA_MAPPING):
         m[0]: (
             dct[m[1]]
             if len(m) == 2
-            else [map_to_bids_names(i, mappings=m[2]) for i in ty.Dict[m[1]]]
+            else _map_nested(map_from_bids_names, dct[m[1]], m[2])
         )
         for m in mappings
-        if dct[m[1]] is not None
+        if dct.get(m[1]) is not None
     }
+
+
+def _map_nested(mapper, value, mappings):
+    """Maps the names of a nested entry, which is either a single object (e.g.
+    'container') or a list of them (e.g. 'generated_by')"""
+    if isinstance(value, dict):
+        return mapper(value, mappings=mappings)
+    return [mapper(i, mappings=mappings) for i in value]
@@ -2,18 +2,28 @@ import typing as ty
 import json
 import itertools
 from pathlib import Path
-from warnings import warn
-import requests.exceptions
 import nibabel as nb
 import numpy.random
 import shutil
 from dataclasses import dataclass
 import pytest
-import docker
+import attrs
+import jq
 from fileformats.medimage import NiftiX
 from frametree.core import __version__
 from frametree.common import Clinical
-from frametree.bids.store import Bids
+from frametree.core.frameset.metadata import (
+    Metadata,
+    GeneratorMetadata,
+    ContainerMetadata,
+)
+from frametree.bids.store import (
+    Bids,
+    map_to_bids_names,
+    map_from_bids_names,
+    _apply_jq_edit,
+    _simple_assignment,
+)
 
 
 MOCK_BIDS_APP_NAME = "mockapp"
@@ -21,7 +31,9 @@ MOCK_README = "A dummy readme\n" * 100
 MOCK_AUTHORS = ["Dumm Y. Author", "Another D. Author"]
 
 
-def test_bids_roundtrip(bids_validator_docker, bids_success_str, work_dir):
+def test_bids_roundtrip(
+    bids_validator_docker, bids_success_str, docker_client, work_dir
+):
 
     path = work_dir / "bids-dataset"
     dataset_name = "adataset"
@@ -85,12 +97,7 @@ def test_bids_roundtrip(bids_validator_docker, bids_success_str, work_dir):
         row["t1w"] = (dummy_nifti, dummy_json)
 
     # Full dataset validation using dockerized validator
-    dc = docker.from_env()
-    try:
-        dc.images.pull(bids_validator_docker)
-    except requests.exceptions.HTTPError:
-        warn("No internet connection, so couldn't download latest BIDS validator")
-    result = dc.containers.run(
+    result = docker_client.containers.run(
         bids_validator_docker,
         "/data",
         volumes=[f"{path}:/data:ro"],
@@ -133,7 +140,7 @@ JSON_EDIT_TESTS = {
             "t1w": SourceNiftiXBlueprint(
                 path="anat/T1w",
                 orig_side_car={"a": {"b": 1.0}},
-                edited_side_car={"a": {"b": 5.0}},
+                edited_side_car={"a": {"b": 5}},
             )
         },
     ),
@@ -144,7 +151,29 @@ JSON_EDIT_TESTS = {
             "t1w": SourceNiftiXBlueprint(
                 path="anat/T1w",
                 orig_side_car={"a": {"b": 1.0, "c": [2, 4, 6]}},
-                edited_side_car={"a": {"b": 5.0, "c": [4, 8, 12]}},
+                edited_side_car={"a": {"b": 5, "c": [4, 8, 12]}},
+            )
+        },
+    ),
+    "assign": JsonEditBlueprint(
+        path_re="anat/T.*w",
+        jq_script='.a.c = ["x", "y"] ',
+        source_niftis={
+            "t1w": SourceNiftiXBlueprint(
+                path="anat/T1w",
+                orig_side_car={"a": {"b": 1.0}},
+                edited_side_car={"a": {"b": 1.0, "c": ["x", "y"]}},
+            )
+        },
+    ),
+    "bool_to_number": JsonEditBlueprint(
+        path_re="anat/T.*w",
+        jq_script=".a.b = 1",
+        source_niftis={
+            "t1w": SourceNiftiXBlueprint(
+                path="anat/T1w",
+                orig_side_car={"a": {"b": True}},
+                edited_side_car={"a": {"b": 1}},
             )
         },
     ),
@@ -244,3 +273,75 @@ def test_bids_json_edit(json_edit_blueprint: JsonEditBlueprint, work_dir: Path):
             saved_dict = json.load(f)
 
         assert saved_dict == sf_bp.edited_side_car
+        # dict equality treats True == 1 == 1.0, so check the serialised types too
+        assert json.dumps(saved_dict) == json.dumps(sf_bp.edited_side_car)
+
+
+@pytest.mark.parametrize(
+    "jq_expr",
+    [
+        ".a.b += 4",  # not an assignment
+        ".a = .b",  # assigns a filter rather than a literal
+        ".a = 1e400",  # out-of-range float, which jq clamps
+        '.a = {"d": 1} | .b = 2',  # literal followed by a further filter
+        ".a = 2.0",  # integral float, which jq writes as an integer
+        ".a = 1E2",
+        ".a = [1, 2.50]",
+        ".a = 9007199254740993",  # integer that jq can't represent exactly
+        '.a = "\\ud83d\\ude00"',  # escaped surrogate pair
+    ],
+)
+def test_jq_edit_fallback(jq_expr):
+    json_dict = {"a": {"b": 1, "c": 2}, "b": "x"}
+    expected = jq.compile(jq_expr).input(value=json_dict).first()
+    edited = _apply_jq_edit(json_dict, jq_expr)
+    # Compare the serialised documents so that e.g. 2.0 and 2 aren't treated as equal
+    assert json.dumps(edited) == json.dumps(expected)
+
+
+@pytest.mark.parametrize(
+    "jq_expr", [".a = NaN", ".a = Infinity", ".aé = 1", '.a = "\\ud800"']
+)
+def test_jq_edit_invalid(jq_expr):
+    # Filters that jq rejects mustn't be applied by the simple assignment path
+    assert _simple_assignment(jq_expr) is None
+    with pytest.raises(ValueError):
+        _apply_jq_edit({}, jq_expr)
+
+
+def test_bids_metadata_name_mapping():
+    metadata = attrs.asdict(
+        Metadata(
+            name="a-dataset",
+            type="raw",
+            authors=MOCK_AUTHORS,
+            generated_by=[
+                GeneratorMetadata(
+                    name="frametree",
+                    description="FrameSet was created programmatically from scratch",
+                    code_url="http://frametree.readthedocs.io",
+                    container=ContainerMetadata(type="docker", tag="latest"),
+                ),
+                GeneratorMetadata(name="no-container"),
+            ],
+        )
+    )
+    bids_dct = map_to_bids_names(metadata)
+    assert bids_dct["Authors"] == MOCK_AUTHORS
+    assert bids_dct["GeneratedBy"][0]["CodeURL"] == "http://frametree.readthedocs.io"
+    assert bids_dct["GeneratedBy"][0]["Container"] == {
+        "Type": "docker",
+        "Tag": "latest",
+    }
+    assert "Container" not in bids_dct["GeneratedBy"][1]
+    mapped_back = map_from_bids_names(bids_dct)
+    assert mapped_back["name"] == "a-dataset"
+    assert mapped_back["type"] == "raw"
+    assert mapped_back["authors"] == MOCK_AUTHORS
+    assert mapped_back["generated_by"][0] == {
+        "name": "frametree",
+        "description": "FrameSet was created programmatically from scratch",
+        "code_url": "http://frametree.readthedocs.io",
+        "container": {"type": "docker", "tag": "latest"},
+    }
+    assert mapped_back["sources"] == []